@@ -7,16 +7,460 @@ ordering
 import warnings
 import sys
 import numpy as np
-from scipy.sparse import issparse, coo_matrix, lil_matrix, find
-from scipy.linalg import toeplitz
-from mdso import SpectralBaseline
+from scipy.sparse import (issparse, coo_matrix, csc_matrix, csr_matrix,
+                          lil_matrix, find)
+from scipy.sparse.csgraph import laplacian
+from scipy.sparse.linalg import eigsh, splu, LinearOperator
+from scipy.linalg import toeplitz, eigh
 import matplotlib.pyplot as plt
 from mdso.spectral_embedding_ import spectral_embedding
+try:
+    from numba import njit, prange
+except ImportError:
+    # without numba, the kernels below run as (much slower) plain Python
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]):
+            return args[0]
+        return lambda func: func
+    prange = range
+try:
+    import pyamg  # noqa: F401
+    _HAS_PYAMG = True
+except ImportError:
+    _HAS_PYAMG = False
+
+# shift used by ARPACK in shift-invert mode. The Laplacian is positive
+# semi-definite, so L - _ARPACK_SHIFT * I is positive definite, and the
+# closer the shift is to 0, the better separated the wanted eigenvalues are
+_ARPACK_SHIFT = -1e-6
+# size above which sparse problems are solved with 'amg' when pyamg is
+# available and no eigen_solver is specified
+_AMG_MIN_SIZE = 2000
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _accumulate_eta(r, c, d_perm, eta_vec, n, dh, circular, scale):
+    """ adds scale * max(dh, |d_perm[r] - d_perm[c]|) to eta_vec in a single
+    pass over the non-zero entries (with the circular distance if required)
+    """
+    for k in prange(len(r)):
+        eta_k = abs(d_perm[r[k]] - d_perm[c[k]])
+        if circular:
+            eta_k = min(eta_k, n - eta_k)
+        eta_vec[k] += scale * max(dh, eta_k)
+
+
+# side of the square tiles of the dense eta updates, small enough for a
+# tile of eta_mat to stay in L2 cache
+_BLOCK = 256
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _dense_eta(d_perm, eta_mat, n, dh, circular, scale, accumulate):
+    """ sets (or adds to, if accumulate) eta_mat the matrix
+    scale * max(dh, |d_perm_i - d_perm_j|) (with the circular distance if
+    required), tile by tile, the rows of tiles being processed in parallel
+    """
+    n_blocks = (n + _BLOCK - 1) // _BLOCK
+    for i_block in prange(n_blocks):
+        i0 = i_block * _BLOCK
+        i1 = min(i0 + _BLOCK, n)
+        for j0 in range(0, n, _BLOCK):
+            j1 = min(j0 + _BLOCK, n)
+            for i in range(i0, i1):
+                for j in range(j0, j1):
+                    eta_ij = abs(d_perm[i] - d_perm[j])
+                    if circular:
+                        eta_ij = min(eta_ij, n - eta_ij)
+                    if accumulate:
+                        eta_mat[i, j] += scale * max(dh, eta_ij)
+                    else:
+                        eta_mat[i, j] = scale * max(dh, eta_ij)
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _psum(perm, r, c, v, p):
+    """ sum_k v_k |perm[r_k] - perm[c_k]|^p in a single pass """
+    score = 0.
+    for k in prange(len(r)):
+        d2diag = abs(perm[r[k]] - perm[c[k]])
+        if p == 1:
+            score += v[k] * d2diag
+        else:
+            score += v[k] * d2diag ** p
+    return score
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _score_1sum(r, c, v, perm, dh, circular, n):
+    score = 0.
+    for k in prange(len(r)):
+        score += v[k] * abs(perm[r[k]] - perm[c[k]])
+    return score
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _score_2sum(r, c, v, perm, dh, circular, n):
+    score = 0.
+    for k in prange(len(r)):
+        d2diag = perm[r[k]] - perm[c[k]]
+        score += v[k] * d2diag * d2diag
+    return score
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _score_huber(r, c, v, perm, dh, circular, n):
+    score = 0.
+    for k in prange(len(r)):
+        d2diag = abs(perm[r[k]] - perm[c[k]])
+        if d2diag <= dh or (circular and d2diag >= n - dh):
+            score += v[k] * d2diag * d2diag
+        else:
+            score += v[k] * (2 * dh * d2diag - dh * dh)
+    return score
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _score_r2s(r, c, v, perm, dh, circular, n):
+    score = 0.
+    for k in prange(len(r)):
+        d2diag = abs(perm[r[k]] - perm[c[k]])
+        if d2diag <= dh or (circular and d2diag >= n - dh):
+            score += v[k] * d2diag * d2diag
+        else:
+            score += v[k] * dh * dh
+    return score
+
+
+# single-pass sparse scores (see _apply_score_function), all with signature
+# (r, c, v, perm, dh, circular, n). Unknown score functions fall back to 1SUM.
+_KERNELS = {'1SUM': _score_1sum,
+            '2SUM': _score_2sum,
+            'Huber': _score_huber,
+            'R2S': _score_r2s}
 
 
-def p_sum_score(X, p=1, permut=None, normalize=False):
+def _invperm(perm):
+    """ returns the inverse of the permutation perm, i.e. np.argsort(perm),
+    with a scatter instead of a sort
+    """
+    p_inv = np.empty_like(perm)
+    p_inv[perm] = np.arange(len(perm))
+    return p_inv
+
+
+def _ranks(v):
+    """ returns the rank of each entry of v, i.e. np.argsort(np.argsort(v)),
+    with a single sort followed by a scatter
+    """
+    return _invperm(np.argsort(v))
+
+
+def _sparse_workspace(X):
+    """ returns X as a canonical coo_matrix (duplicates summed, entries sorted
+    by row then column) and a float csr_matrix X_w with the same sparsity
+    pattern, whose data array is aligned with the coo one so that it can be
+    overwritten in-place at each iteration
+    """
+    # the coo entries are taken from the canonical csr matrix, hence in its
+    # (row-major) order by construction
+    X_w = csr_matrix(X, copy=True)
+    X_w.sum_duplicates()
+    X = X_w.tocoo(copy=True)
+    X_w = X_w.astype(np.float64, copy=False)
+    assert np.array_equal(X_w.indices, X.col)
+
+    return X, X_w
+
+
+class _LaplacianWorkspace():
+    """ Laplacian (as scipy's csgraph.laplacian) of the weighted matrices
+    X_w sharing the sparsity pattern of the canonical coo_matrix X, as
+    returned by _sparse_workspace.
+    The csc structure of L (pattern of X plus the diagonal) and the position
+    in L.data of the off-diagonal entries of X and of the diagonal are
+    computed once; update() then only rewrites the data arrays of L and of
+    the shifted matrix L - sigma * I factorized by ARPACK in shift-invert mode.
+    """
+
+    def __init__(self, X, norm_laplacian=None, sigma=None):
+        n = X.shape[0]
+        self.n = n
+        self.normed = norm_laplacian in ('symmetric', 'random_walk')
+        self.sigma = _ARPACK_SHIFT if sigma is None else sigma
+        # the diagonal of X is ignored, as in csgraph.laplacian
+        self.off_diag = (X.row != X.col)
+        self.r = X.row[self.off_diag]
+        self.c = X.col[self.off_diag]
+
+        # sorting the entries by column then row gives the csc order
+        keys = self.c.astype(np.int64) * n + self.r
+        diag_keys = np.arange(n, dtype=np.int64) * (n + 1)
+        lap_keys = np.union1d(keys, diag_keys)
+        self.w_pos = np.searchsorted(lap_keys, keys)
+        self.d_pos = np.searchsorted(lap_keys, diag_keys)
+
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(lap_keys // n, minlength=n), out=indptr[1:])
+        indices = lap_keys % n
+        self.lap = csc_matrix((np.zeros(len(lap_keys)), indices, indptr),
+                              shape=(n, n))
+        self.shifted = csc_matrix((np.zeros(len(lap_keys)), indices, indptr),
+                                  shape=(n, n))
+
+    def update(self, w):
+        """ fills L from the data w of X_w (aligned with X.data) and returns
+        it with its diagonal term, like csgraph.laplacian(return_diag=True)
+        """
+        w = w[self.off_diag]
+        deg = np.bincount(self.c, weights=w, minlength=self.n)
+        lap_data = self.lap.data
+        if self.normed:
+            is_isolated = (deg == 0)
+            dd = np.where(is_isolated, 1, np.sqrt(deg))
+            lap_data[self.w_pos] = -w / (dd[self.r] * dd[self.c])
+            lap_data[self.d_pos] = 1 - is_isolated
+        else:
+            dd = deg
+            lap_data[self.w_pos] = -w
+            lap_data[self.d_pos] = deg
+
+        np.copyto(self.shifted.data, lap_data)
+        self.shifted.data[self.d_pos] -= self.sigma
+
+        return self.lap, dd
+
+    def opinv(self):
+        """ (L - sigma * I)^{-1} for eigsh, factorized from the csc matrix
+        updated in-place (instead of eigsh building L - sigma * I itself)
+        """
+        lu = splu(self.shifted)
+        return LinearOperator((self.n, self.n), matvec=lu.solve,
+                              dtype=np.float64)
+
+
+@njit(fastmath=True, cache=True)
+def _entry_score(d2diag, dh, circular, n, kind):
+    """ contribution to the kind-th score of _KINDS of an entry (with unit
+    weight) at distance d2diag from the diagonal
+    """
+    d2diag = abs(d2diag)
+    if kind == 1 or (kind > 1 and
+                     (d2diag <= dh or (circular and d2diag >= n - dh))):
+        return d2diag * d2diag
+    if kind == 2:
+        return 2 * dh * d2diag - dh * dh
+    if kind == 3:
+        return dh * dh
+    return d2diag
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def _score_delta(moved, is_moved, row_ptr, col_ptr, col_order, r, c, v,
+                 perm, new_perm, dh, circular, n, kind):
+    """ score(new_perm) - score(perm) from the entries in the rows and
+    columns of the moved elements (is_moved being their mask), each entry
+    being visited once: through its row if the latter is moved, and through
+    its column otherwise
+    """
+    delta = 0.
+    for m in prange(len(moved)):
+        i = moved[m]
+        for k in range(row_ptr[i], row_ptr[i + 1]):
+            delta += v[k] * (
+                _entry_score(new_perm[i] - new_perm[c[k]], dh, circular, n,
+                             kind) -
+                _entry_score(perm[i] - perm[c[k]], dh, circular, n, kind))
+        for kk in range(col_ptr[i], col_ptr[i + 1]):
+            k = col_order[kk]
+            if not is_moved[r[k]]:
+                delta += v[k] * (
+                    _entry_score(new_perm[r[k]] - new_perm[i], dh, circular,
+                                 n, kind) -
+                    _entry_score(perm[r[k]] - perm[i], dh, circular, n,
+                                 kind))
+    return delta
+
+
+@njit(cache=True)
+def _moved_elements(perm, new_perm, n_entries, budget, moved):
+    """ writes in moved the elements whose rank differs in perm and new_perm
+    and returns their number, or -1 as soon as the number of entries in their
+    rows and columns (n_entries) exceeds budget
+    """
+    n_moved = 0
+    n_touched = 0
+    for i in range(len(perm)):
+        if perm[i] != new_perm[i]:
+            n_touched += n_entries[i]
+            if n_touched > budget:
+                return -1
+            moved[n_moved] = i
+            n_moved += 1
+    return n_moved
+
+
+# index of the score functions in _entry_score (unknown ones being 1SUM)
+_KINDS = {'1SUM': 0,
+          '2SUM': 1,
+          'Huber': 2,
+          'R2S': 3}
+
+# per entry visited, the incremental update (scattered, not vectorized reads)
+# costs about 25 times more than the full score on a banded 200000 x 200000
+# matrix: it is only used when the moved elements hold less than
+# 1/_INCREMENTAL_RATIO of the non-zero entries
+_INCREMENTAL_RATIO = 50
+
+
+class _IncrementalScore():
+    """ (linear) sparse score of the successive orderings visited by an
+    eta-trick loop, as computed by compute_score, for a coo_matrix X without
+    duplicate entries (e.g. as returned by _sparse_workspace).
+    Only the entries in the rows and columns of the elements whose rank
+    changed since the previous call contribute to the score difference.
+    When they are few (near convergence), the score is updated from them
+    instead of being recomputed over all the non-zero entries.
+    """
+
+    def __init__(self, X, score_function='1SUM', dh=1, perm=None, score=None):
+        n = X.shape[0]
+        self.n = n
+        r, c, v = X.row, X.col, X.data
+        if np.any(r[1:] < r[:-1]):
+            # sort the entries by row to find the ones in a given row
+            order = np.argsort(r, kind='stable')
+            r, c, v = r[order], c[order], v[order]
+        self.r, self.c, self.v = r, c, v
+        self.score_fn = _KERNELS.get(score_function, _score_1sum)
+        self.kind = _KINDS.get(score_function, 0)
+        self.dh = int(dh)
+        # and by column too to find the ones in a given column
+        self.row_ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.r, minlength=n), out=self.row_ptr[1:])
+        self.col_order = np.argsort(self.c, kind='stable')
+        self.col_ptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.c, minlength=n), out=self.col_ptr[1:])
+        # entries in the row and column of each element
+        self.n_entries = np.diff(self.row_ptr) + np.diff(self.col_ptr)
+        self.budget = len(self.v) // _INCREMENTAL_RATIO
+        self.moved = np.empty(n, dtype=np.int64)
+        self.is_moved = np.zeros(n, dtype=bool)
+
+        self.perm = np.arange(n) if perm is None else perm
+        if score is None:
+            score = self._full_score(self.perm)
+        self.score = score
+
+    def _full_score(self, perm):
+        return self.score_fn(self.r, self.c, self.v, perm, self.dh, False,
+                             self.n)
+
+    def __call__(self, new_perm):
+        n_moved = _moved_elements(self.perm, new_perm, self.n_entries,
+                                  self.budget, self.moved)
+        if n_moved >= 0:
+            moved = self.moved[:n_moved]
+            self.is_moved[moved] = True
+            delta = _score_delta(moved, self.is_moved, self.row_ptr,
+                                 self.col_ptr, self.col_order, self.r, self.c,
+                                 self.v, self.perm, new_perm, self.dh, False,
+                                 self.n, self.kind)
+            self.is_moved[moved] = False
+            new_score = self.score + delta
+        else:
+            new_score = self._full_score(new_perm)
+
+        self.perm = new_perm
+        self.score = new_score
+
+        return new_score
+
+
+def _uses_arpack(eigen_solver=None, norm_adjacency=None):
+    """ whether _spectral_embedding computes the embedding itself (with
+    ARPACK) rather than handing off to mdso """
+    return eigen_solver in (None, 'arpack') and not norm_adjacency
+
+
+def _spectral_embedding(X_w, n_components=8, norm_laplacian=None,
+                        norm_adjacency=None, eigen_solver=None,
+                        scale_embedding=False, warm_start=None,
+                        lap_workspace=None):
+    """ spectral embedding of X_w (spanning the same subspace as mdso's
+    spectral_embedding, up to the signs and the basis of the eigenvectors)
+    computed with ARPACK, which can be warm-started from the embedding of
+    the previous eta-trick iteration (warm_start, with shape (n, d)).
+    Since eta only rescales the edge weights slightly from one iteration to
+    the next, the eigenvectors barely move and Lanczos converges faster.
+    If X_w is sparse, lap_workspace (a _LaplacianWorkspace built from its
+    sparsity pattern) avoids rebuilding the structure of the Laplacian.
+    The other eigen solvers and the adjacency normalization are left to mdso.
+    """
+    if not _uses_arpack(eigen_solver, norm_adjacency):
+        return spectral_embedding(X_w, norm_laplacian=norm_laplacian,
+                                  norm_adjacency=norm_adjacency,
+                                  eigen_solver=eigen_solver,
+                                  scale_embedding=scale_embedding,
+                                  n_components=n_components)
+
+    n = X_w.shape[0]
+    normed = norm_laplacian in ('symmetric', 'random_walk')
+    if lap_workspace is not None:
+        lap, dd = lap_workspace.update(X_w.data)
+    else:
+        lap, dd = laplacian(X_w, normed=normed, return_diag=True)
+
+    if n_components + 1 >= n - 1:
+        # too many eigenvectors for ARPACK (which needs k < n - 1): like mdso,
+        # solve the (small) dense problem
+        lambdas, eigvecs = eigh(lap.toarray() if issparse(lap) else lap)
+        k = min(n_components + 1, n)
+        lambdas, eigvecs = lambdas[:k], eigvecs[:, :k]
+    else:
+        if warm_start is None:
+            v0 = np.random.uniform(-1, 1, n)
+        else:
+            # the starting vector needs a component along each wanted
+            # eigenvector, including the trivial one, which the previous
+            # (non-trivial) eigenvectors are orthogonal to
+            v0 = np.sum(warm_start / np.linalg.norm(warm_start, axis=0),
+                        axis=1)
+            v0 += 1. / np.sqrt(n)
+
+        # L - sigma * I is only factorized when ARPACK needs it
+        opinv = lap_workspace.opinv() if lap_workspace is not None else None
+        lambdas, eigvecs = eigsh(lap, n_components + 1, sigma=_ARPACK_SHIFT,
+                                 which='LM', v0=v0, OPinv=opinv)
+    # sort by increasing eigenvalue and drop the first (trivial) one
+    order = np.argsort(lambdas)[1:]
+    lambdas = lambdas[order]
+    embedding = eigvecs[:, order]
+    if norm_laplacian == 'random_walk':
+        embedding /= dd[:, np.newaxis]
+
+    if scale_embedding == 'CTD':
+        embedding /= np.sqrt(lambdas)
+    elif scale_embedding:
+        embedding /= np.sqrt(np.arange(1, len(lambdas) + 1))
+
+    return embedding
+
+
+def _spectral_ordering(embedding, circular=False):
+    """ ordering from a spectral embedding, as with mdso's SpectralBaseline:
+    sorts the Fiedler vector, or, if circular, the angles of the nodes in the
+    plane of the first two non-trivial eigenvectors
+    """
+    if circular:
+        return np.argsort(np.arctan2(embedding[:, 1], embedding[:, 0]))
+    return np.argsort(embedding[:, 0])
+
+
+def p_sum_score(X, p=1, permut=None, normalize=False, D2diag_mat=None):
     """ computes the p-sum score of X or X[permut, :][:, permut] if permutation
-    provided
+    provided. For dense X, D2diag_mat = toeplitz(np.arange(n)**p) can be
+    given to avoid rebuilding it at each call.
     """
     if issparse(X):
         if not isinstance(X, coo_matrix):
@@ -24,31 +468,22 @@ def p_sum_score(X, p=1, permut=None, normalize=False):
 
         r, c, v = X.row, X.col, X.data
 
-        if permut is not None:
-            d2diag = abs(permut[r] - permut[c])
-        else:
-            d2diag = abs(r - c)
-
-        if p != 1:
-            d2diag **= p
+        if permut is None:
+            permut = np.arange(X.shape[0])
 
-        prod = np.multiply(v, d2diag)
-        score = np.sum(prod)
+        score = _psum(permut, r, c, v, p)
 
     else:
+        if D2diag_mat is None:
+            d2diagv = np.arange(X.shape[0])
+            if p != 1:
+                d2diagv **= p
+            D2diag_mat = toeplitz(d2diagv)
         if permut is not None:
-            X_p = X.copy()[permut, :]
-            X_p = X_p.T[permut, :].T
-        else:
-            X_p = X
-
-        n = X_p.shape[0]
-        d2diagv = np.arange(n)
-        if p != 1:
-            d2diagv **= p
-        D2diag_mat = toeplitz(d2diagv)
-        prod = np.multiply(X_p, D2diag_mat)
-        score = np.sum(prod)
+            # score of X[permut, :][:, permut], without permuting X
+            p_inv = _invperm(permut)
+            D2diag_mat = D2diag_mat[p_inv[:, None], p_inv[None, :]]
+        score = np.einsum('ij,ij->', X, D2diag_mat)
 
     return score
 
@@ -62,9 +497,7 @@ def plot_mat(X, title='', permut=None):
             pjs = permut[jjs]
             # Xl = X.tolil(copy=True)
         else:
-            Xl = X.copy()
-            Xl = Xl[permut, :]
-            Xl = Xl.T[permut, :].T
+            Xl = X.take(permut, axis=0).take(permut, axis=1)
 
     fig = plt.figure(1)
     plt.gcf().clear()
@@ -104,86 +537,125 @@ def spectral_eta_trick(X, n_iter=50, dh=1, score_function='1SUM', return_score=F
     (n, n2) = X.shape
     assert(n == n2)
 
-    spectral_algo = SpectralBaseline(circular=circular,
-                                     norm_laplacian=norm_laplacian,
-                                     norm_adjacency=norm_adjacency,
-                                     eigen_solver=eigen_solver,
-                                     scale_embedding=scale_embedding)
+    # same defaults as mdso's SpectralBaseline
+    if circular and not norm_laplacian:
+        norm_laplacian = 'random_walk'
+    n_components = 2 if circular else 1
+    prev_embedding = None
 
     best_perm = np.random.permutation(n)
     best_score = compute_score(X, score_function=score_function, dh=dh, perm=best_perm)
     # best_score = n**(p+2)
 
     if issparse(X):
-        if not isinstance(X, coo_matrix):
-            X = coo_matrix(X)
-
+        X, X_w = _sparse_workspace(X)
+        # the workspace and the warm start are only used by ARPACK
+        use_arpack = _uses_arpack(eigen_solver, norm_adjacency)
+        if use_arpack:
+            lap_workspace = _LaplacianWorkspace(X,
+                                                norm_laplacian=norm_laplacian)
+        else:
+            lap_workspace = None
         r, c, v = X.row, X.col, X.data
-        eta_vec = np.ones(len(v))
-        # if add_momentum:
-        #     eta_old = np.ones(len(v))
+        # eta only reweights the edges: single precision is enough and halves
+        # the memory traffic of its updates
+        eta_vec = np.ones(len(v), dtype=np.float32)
+        if add_momentum:
+            eta_old = np.empty_like(eta_vec)
+
+        # same (linear) score as compute_score, updated incrementally
+        score_fn = _IncrementalScore(X, score_function=score_function, dh=dh,
+                                     perm=best_perm, score=best_score)
+
+        # 32-bit indices and ranks halve the bytes moved by the gathers below
+        idx_dtype = np.int32 if n < np.iinfo(np.int32).max else np.int64
+        r_idx = r.astype(idx_dtype, copy=False)
+        c_idx = c.astype(idx_dtype, copy=False)
+        p_r = np.empty(len(v), dtype=idx_dtype)
+        p_c = np.empty_like(p_r)
+        if circular:
+            eta_tmp = np.empty_like(eta_vec)
 
         for it in range(n_iter):
 
-            X_w = X.copy()
-            X_w.data /= eta_vec
+            np.divide(v, eta_vec, out=X_w.data)
 
             if add_momentum:
-                eta_old = eta_vec
-
-            new_perm = spectral_algo.fit_transform(X_w)
-            if np.all(new_perm == best_perm):
+                np.copyto(eta_old, eta_vec)
+
+            embedding = _spectral_embedding(X_w, n_components=n_components,
+                                            norm_laplacian=norm_laplacian,
+                                            norm_adjacency=norm_adjacency,
+                                            eigen_solver=eigen_solver,
+                                            scale_embedding=scale_embedding,
+                                            warm_start=prev_embedding,
+                                            lap_workspace=lap_workspace)
+            if use_arpack:
+                prev_embedding = embedding
+            new_perm = _spectral_ordering(embedding, circular=circular)
+            if np.array_equal(new_perm, best_perm):
                 break
             # if new_perm[0] > new_perm[-1]:
             #     new_perm *= -1
             #     new_perm += (n-1)  # should it not be n-1 instead of n ?!
 
             # new_score = p_sum_score(X, permut=new_perm, p=p)
-            new_score = compute_score(X, score_function=score_function, dh=dh, perm=new_perm)
+            new_score = score_fn(new_perm)
             if new_score < best_score:
                 best_perm = new_perm
 
-            p_inv = np.argsort(new_perm)
+            p_inv = _invperm(new_perm).astype(idx_dtype, copy=False)
 
-            eta_vec = abs(p_inv[r] - p_inv[c])
+            np.take(p_inv, r_idx, out=p_r, mode='clip')
+            np.take(p_inv, c_idx, out=p_c, mode='clip')
+            np.subtract(p_r, p_c, out=eta_vec)
+            np.abs(eta_vec, out=eta_vec)
             if circular:
                 # pass
-                eta_vec = np.minimum(eta_vec, n - eta_vec)
-            eta_vec = np.maximum(dh, eta_vec)
+                np.subtract(n, eta_vec, out=eta_tmp)
+                np.minimum(eta_vec, eta_tmp, out=eta_vec)
+            np.maximum(dh, eta_vec, out=eta_vec)
 
             if add_momentum:
-                eta_vec = (1-add_momentum) * eta_vec + add_momentum * eta_old
+                eta_vec *= (1-add_momentum)
+                eta_vec += add_momentum * eta_old
 
             if do_plot:
                 title = "it %d, score: %1.5e" % (it, new_score)
                 plot_mat(X, permut=new_perm, title=title)
 
     else:
-        eta_mat = np.ones((n, n))
+        eta_mat = np.ones((n, n), dtype=np.float32)
+        D2diag_mat = toeplitz(_make_d2diagv(n, score_function=score_function,
+                                            dh=dh))
+        X_w = np.empty((n, n))
 
         for it in range(n_iter):
 
-            X_w = np.divide(X, eta_mat)
-            new_perm = spectral_algo.fit_transform(X_w)
+            np.divide(X, eta_mat, out=X_w)
+            embedding = _spectral_embedding(X_w, n_components=n_components,
+                                            norm_laplacian=norm_laplacian,
+                                            norm_adjacency=norm_adjacency,
+                                            eigen_solver=eigen_solver,
+                                            scale_embedding=scale_embedding,
+                                            warm_start=prev_embedding)
+            prev_embedding = embedding
+            new_perm = _spectral_ordering(embedding, circular=circular)
             # if new_perm[0] > new_perm[-1]:
             #     new_perm *= -1
             #     new_perm += (n-1)
-            if np.all(new_perm == best_perm):
+            if np.array_equal(new_perm, best_perm):
                 break
 
             # new_score = p_sum_score(X, permut=new_perm, p=p)
-            new_score = compute_score(X, score_function=score_function, dh=dh, perm=new_perm)
+            new_score = compute_score(X, score_function=score_function, dh=dh, perm=new_perm,
+                                      D2diag_mat=D2diag_mat)
             if new_score < best_score:
                 best_perm = new_perm
 
-            p_inv = np.argsort(new_perm)
+            p_inv = _invperm(new_perm)
 
-            eta_mat = abs(np.tile(p_inv, n) - np.repeat(p_inv, n))
-            if circular:
-                # pass
-                eta_mat = np.minimum(eta_mat, n - eta_mat)
-            eta_mat = np.reshape(eta_mat, (n, n))
-            eta_mat = np.maximum(dh, eta_mat)
+            _dense_eta(p_inv, eta_mat, n, dh, circular, 1., False)
 
             if do_plot:
                 title = "it %d, score: %1.5e" % (it, new_score)
@@ -218,34 +690,30 @@ def spectral_eta_trick2(X, n_iter=50, dh=1, p=1, return_score=False,
         else:
             return(best_perm)
 
-    spectral_algo = SpectralBaseline(circular=circular,
-                                     norm_laplacian=norm_laplacian,
-                                     norm_adjacency=norm_adjacency,
-                                     eigen_solver=eigen_solver,
-                                     scale_embedding=scale_embedding)
-
     best_perm = np.arange(n)
     best_score = n**(p+2)
 
     if issparse(X):
-        if not isinstance(X, coo_matrix):
-            X = coo_matrix(X)
-
+        X, X_w = _sparse_workspace(X)
+        lap_workspace = _LaplacianWorkspace(X)
         r, c, v = X.row, X.col, X.data
         eta_vec = np.ones(len(v))
         if add_momentum:
             eta_old = np.ones(len(v))
 
+        prev_embedding = None
+
         for it in range(n_iter):
 
-            X_w = X.copy()
-            X_w.data /= eta_vec
+            np.divide(v, eta_vec, out=X_w.data)
 
-            embedding = spectral_embedding(X_w)
+            embedding = _spectral_embedding(X_w, warm_start=prev_embedding,
+                                            lap_workspace=lap_workspace)
             new_perm = np.argsort(embedding[:, 0])
+            prev_embedding = embedding
 
             # new_perm = spectral_algo.fit_transform(X_w)
-            if np.all(new_perm == best_perm):
+            if np.array_equal(new_perm, best_perm):
                 break
             if new_perm[0] > new_perm[-1]:
                 embedding = embedding[::-1, :]
@@ -256,8 +724,6 @@ def spectral_eta_trick2(X, n_iter=50, dh=1, p=1, return_score=False,
             if new_score < best_score:
                 best_perm = new_perm
 
-            p_inv = np.argsort(new_perm)
-
             # eta_vec = abs(p_inv[r] - p_inv[c])
             d_ = 3
             eta_vec = np.sum(abs(embedding[r, :d_] - embedding[c, :d_]), axis=1)
@@ -272,12 +738,16 @@ def spectral_eta_trick2(X, n_iter=50, dh=1, p=1, return_score=False,
 
     else:
         eta_mat = np.ones((n, n))
+        D2diag_mat = toeplitz(np.arange(n)**p)
+
+        prev_embedding = None
 
         for it in range(n_iter):
 
             X_w = np.divide(X, eta_mat)
-            embedding = spectral_embedding(X_w)
+            embedding = _spectral_embedding(X_w, warm_start=prev_embedding)
             new_perm = np.argsort(embedding[:, 0])
+            prev_embedding = embedding
 
             # new_perm = spectral_algo.fit_transform(X_w)
             # if new_perm[0] > new_perm[-1]:
@@ -287,20 +757,18 @@ def spectral_eta_trick2(X, n_iter=50, dh=1, p=1, return_score=False,
             # if np.all(new_perm == best_perm):
             #     break
 
-            new_score = p_sum_score(X, permut=new_perm, p=p)
+            new_score = p_sum_score(X, permut=new_perm, p=p, D2diag_mat=D2diag_mat)
             if new_score < best_score:
                 best_perm = new_perm
 
-            p_inv = np.argsort(new_perm)
-
             d_ = 5
             d_ = min(n-1, d_)
             # eta_vec = np.sum(abs(embedding[r, :d_] - embedding[c, :d_]), axis=1)
-            eta_mat = np.identity(n).flatten()
+            eta_mat = np.zeros(n * n)
+            eta_mat[::n + 1] = 1.
             for dim in range(d_):
                 # eta_mat = eta_mat + abs(np.tile(embedding[:, dim], n) - np.repeat(embedding[:, dim], n))
-                d_perm = np.argsort(embedding[:, dim])
-                d_perm = (1./(1 + dim)) * np.argsort(d_perm)
+                d_perm = (1./(1 + dim)) * _ranks(embedding[:, dim])
                 eta_mat = eta_mat + abs(np.tile(d_perm, n) - np.repeat(d_perm, n))
 
             # eta_mat = abs(np.tile(p_inv, n) - np.repeat(p_inv, n))
@@ -320,9 +788,43 @@ def spectral_eta_trick2(X, n_iter=50, dh=1, p=1, return_score=False,
         return(best_perm)
 
 
-def compute_score(X, score_function='1SUM', dh=1, perm=None, circular=False):
+def _apply_score_function(d2diag, score_function='1SUM', dh=1, n=None,
+                          circular=False):
+    """ maps in-place the distances |pi_i - pi_j| in d2diag to their
+    contribution to the score (squared for 2SUM, Huber or robust 2SUM
+    with parameter dh), without building index arrays for the band
+    """
+    if score_function == '2SUM':
+        d2diag **= 2
+    elif score_function in ('Huber', 'R2S'):
+        is_in_band = (d2diag <= dh)
+        if circular:
+            is_in_band |= (d2diag >= n - dh)
+        in_band_val = np.multiply(d2diag, d2diag)
+        if score_function == 'Huber':
+            np.multiply(d2diag, 2 * dh, out=d2diag)
+            np.subtract(d2diag, dh**2, out=d2diag)
+        else:
+            d2diag.fill(dh**2)
+        np.copyto(d2diag, in_band_val, where=is_in_band)
+
+    return d2diag
+
+
+def _make_d2diagv(n, score_function='1SUM', dh=1, circular=False):
+    """ cost of two elements placed at distance k = 0, ..., n-1 in the
+    ordering, i.e., the first row of the Toeplitz matrix of the dense score
+    """
+    d2diagv = np.arange(n)
+    return _apply_score_function(d2diagv, score_function=score_function, dh=dh,
+                                 n=n, circular=circular)
+
+
+def compute_score(X, score_function='1SUM', dh=1, perm=None, circular=False,
+                  D2diag_mat=None):
     """ computes the p-sum score of X or X[perm, :][:, perm] if permutation
-    provided
+    provided. For dense X, D2diag_mat = toeplitz(_make_d2diagv(n, ...)) can
+    be given to avoid rebuilding it at each call.
     """
 
     (n, _) = X.shape
@@ -332,69 +834,24 @@ def compute_score(X, score_function='1SUM', dh=1, perm=None, circular=False):
 
         r, c, v = X.row, X.col, X.data
 
-        if perm is not None:
-            d2diag = abs(perm[r] - perm[c])
-        else:
-            d2diag = abs(r - c)
+        if perm is None:
+            perm = np.arange(n)
 
         if not isinstance(dh, int):
             dh = int(dh)
 
-        if score_function == '2SUM':
-            d2diag **= 2
-        elif score_function == 'Huber':
-            is_in_band = (d2diag <= dh)
-            if circular:
-                is_in_band += (d2diag >= n - dh)
-            in_band = np.where(is_in_band)[0]
-            out_band = np.where(~is_in_band)[0]
-            d2diag[in_band] **= 2
-            d2diag[out_band] *= 2 * dh
-            d2diag[out_band] -= dh**2
-        elif score_function == 'R2S':
-            is_in_band = (d2diag <= dh)
-            if circular:
-                is_in_band += (d2diag >= n - dh)
-            in_band = np.where(is_in_band)[0]
-            out_band = np.where(~is_in_band)[0]
-            d2diag[in_band] **= 2
-            d2diag[out_band] = dh**2
-
-        prod = np.multiply(v, d2diag)
-        score = np.sum(prod)
+        score_fn = _KERNELS.get(score_function, _score_1sum)
+        score = score_fn(r, c, v, perm, dh, circular, n)
 
     else:
+        if D2diag_mat is None:
+            D2diag_mat = toeplitz(_make_d2diagv(n, score_function=score_function,
+                                                dh=dh, circular=circular))
         if perm is not None:
-            X_p = X.copy()[perm, :]
-            X_p = X_p.T[perm, :].T
-        else:
-            X_p = X
-
-        n = X_p.shape[0]
-        d2diagv = np.arange(n)
-        if score_function == '2SUM':
-            d2diagv **= 2
-        elif score_function == 'Huber':
-            is_in_band = (d2diagv <= dh)
-            if circular:
-                is_in_band += (d2diagv >= n - dh)
-            in_band = np.where(is_in_band)[0]
-            out_band = np.where(~is_in_band)[0]
-            d2diagv[in_band] **= 2
-            d2diagv[out_band] *= 2 * dh
-            d2diagv[out_band] -= dh**2
-        elif score_function == 'R2S':
-            is_in_band = (d2diagv <= dh)
-            if circular:
-                is_in_band += (d2diagv >= n - dh)
-            in_band = np.where(is_in_band)[0]
-            out_band = np.where(~is_in_band)[0]
-            d2diagv[in_band] **= 2
-            d2diagv[out_band] = dh**2
-
-        D2diag_mat = toeplitz(d2diagv)
-        prod = np.multiply(X_p, D2diag_mat)
-        score = np.sum(prod)
+            # score of X[perm, :][:, perm], without permuting X
+            p_inv = _invperm(perm)
+            D2diag_mat = D2diag_mat[p_inv[:, None], p_inv[None, :]]
+        score = np.einsum('ij,ij->', X, D2diag_mat)
 
     return score
 
@@ -431,10 +888,11 @@ def spectral_eta_trick3(X, n_iter=50, dh=1, score_function='Huber', return_score
         circular : boolean, default False
             Whether we wish to find a circular or a linear ordering.
 
-        eigen_solver : string, default 'arpack'
+        eigen_solver : string, default None
             Solver for the eigenvectors computations. Can be 'arpack', 'amg', or
             'lopbcg'. 'amg' is faster for large sparse matrices but requires the
-            pyamg package.
+            pyamg package. If None, 'amg' is used for sparse matrices with more
+            than 2000 rows when pyamg is installed, and 'arpack' otherwise.
 
         add_momentum : Nonetype or float, default None.
             gamma parameter in Algorithm... from the paper.
@@ -489,66 +947,73 @@ def spectral_eta_trick3(X, n_iter=50, dh=1, score_function='Huber', return_score
         else:
             return(best_perm)
 
+    if (eigen_solver is None and issparse(X) and n > _AMG_MIN_SIZE and
+            _HAS_PYAMG):
+        eigen_solver = 'amg'
+
     best_perm = np.arange(n)
     best_score = compute_score(X, score_function=score_function, dh=dh, perm=None)
 
     if issparse(X):
-        if not isinstance(X, coo_matrix):
-            X = coo_matrix(X)
-
+        X, X_w = _sparse_workspace(X)
+        # the workspace and the warm start are only used by ARPACK
+        use_arpack = _uses_arpack(eigen_solver, norm_adjacency)
+        if use_arpack:
+            lap_workspace = _LaplacianWorkspace(X,
+                                                norm_laplacian=norm_laplacian)
+        else:
+            lap_workspace = None
         r, c, v = X.row, X.col, X.data
-        eta_vec = np.ones(len(v))
+        eta_vec = np.ones(len(v), dtype=np.float32)
         if add_momentum:
-            eta_old = np.ones(len(v))
+            eta_old = np.ones(len(v), dtype=np.float32)
+
+        # same (linear) score as compute_score, updated incrementally
+        score_fn = _IncrementalScore(X, score_function=score_function, dh=dh,
+                                     perm=best_perm, score=best_score)
+
+        prev_embedding = None
 
         for it in range(n_iter):
 
-            X_w = X.copy()
-            X_w.data /= eta_vec
+            np.divide(v, eta_vec, out=X_w.data)
 
             default_dim = 8
             if avg_dim > default_dim:
                 default_dim = avg_dim + 1
 
-            embedding = spectral_embedding(X_w, norm_laplacian=norm_laplacian,
-                                           norm_adjacency=norm_adjacency,
-                                           eigen_solver=eigen_solver,
-                                           scale_embedding=scale_embedding,
-                                           n_components=default_dim)
+            embedding = _spectral_embedding(X_w, norm_laplacian=norm_laplacian,
+                                            norm_adjacency=norm_adjacency,
+                                            eigen_solver=eigen_solver,
+                                            scale_embedding=scale_embedding,
+                                            n_components=default_dim,
+                                            warm_start=prev_embedding,
+                                            lap_workspace=lap_workspace)
 
             new_perm = np.argsort(embedding[:, 0])
+            if use_arpack:
+                prev_embedding = embedding
 
             # new_perm = spectral_algo.fit_transform(X_w)
-            if np.all(new_perm == best_perm):
+            if np.array_equal(new_perm, best_perm):
                 break
             if new_perm[0] > new_perm[-1]:
                 embedding = embedding[::-1, :]
                 new_perm *= -1
                 new_perm += (n-1)
 
-            new_score = compute_score(X, score_function=score_function, dh=dh, perm=new_perm)
+            new_score = score_fn(new_perm)
             if new_score < best_score:
                 best_perm = new_perm
 
-            p_inv = np.argsort(new_perm)
-
             # eta_vec = abs(p_inv[r] - p_inv[c])
-            eta_vec = np.zeros(len(r))
+            eta_vec.fill(0.)
             d_ = min(avg_dim, n-1)
             for dim in range(d_):
                 # eta_mat = eta_mat + abs(np.tile(embedding[:, dim], n) - np.repeat(embedding[:, dim], n))
-                d_perm = np.argsort(embedding[:, dim])
-                d_perm = np.argsort(d_perm)
-                eta_add = abs(d_perm[r] - d_perm[c])
-                if circular:
-                    eta_add = np.minimum(eta_add, n - eta_add)
-
-                eta_add = np.maximum(dh, eta_add)
-
-                if avg_scaling:
-                    eta_add = eta_add * 1./np.sqrt(1 + dim)
-
-                eta_vec += eta_add
+                d_perm = _ranks(embedding[:, dim])
+                scale = 1./np.sqrt(1 + dim) if avg_scaling else 1.
+                _accumulate_eta(r, c, d_perm, eta_vec, n, dh, circular, scale)
             #     eta_mat = eta_mat + abs(np.tile(d_perm, n) - np.repeat(d_perm, n))
             # eta_vec = np.sum(abs(embedding[r, :d_] - embedding[c, :d_]), axis=1)
             # if circular:
@@ -561,23 +1026,30 @@ def spectral_eta_trick3(X, n_iter=50, dh=1, score_function='Huber', return_score
                 plot_mat(X, permut=new_perm, title=title)
 
     else:
-        eta_mat = np.ones((n, n))
+        eta_mat = np.ones((n, n), dtype=np.float32)
+        D2diag_mat = toeplitz(_make_d2diagv(n, score_function=score_function,
+                                            dh=dh))
+        X_w = np.empty((n, n))
+
+        prev_embedding = None
 
         for it in range(n_iter):
 
-            X_w = np.divide(X, eta_mat)
+            np.divide(X, eta_mat, out=X_w)
 
             default_dim = 8
             if avg_dim > default_dim:
                 default_dim = avg_dim + 1
 
-            embedding = spectral_embedding(X_w, norm_laplacian=norm_laplacian,
-                                           norm_adjacency=norm_adjacency,
-                                           eigen_solver=eigen_solver,
-                                           scale_embedding=scale_embedding,
-                                           n_components=default_dim)
+            embedding = _spectral_embedding(X_w, norm_laplacian=norm_laplacian,
+                                            norm_adjacency=norm_adjacency,
+                                            eigen_solver=eigen_solver,
+                                            scale_embedding=scale_embedding,
+                                            n_components=default_dim,
+                                            warm_start=prev_embedding)
 
             new_perm = np.argsort(embedding[:, 0])
+            prev_embedding = embedding
 
             # new_perm = spectral_algo.fit_transform(X_w)
             # if new_perm[0] > new_perm[-1]:
@@ -587,36 +1059,26 @@ def spectral_eta_trick3(X, n_iter=50, dh=1, score_function='Huber', return_score
             # if np.all(new_perm == best_perm):
             #     break
 
-            new_score = compute_score(X, score_function=score_function, dh=dh, perm=new_perm)
+            new_score = compute_score(X, score_function=score_function, dh=dh, perm=new_perm,
+                                      D2diag_mat=D2diag_mat)
             if new_score < best_score:
                 best_perm = new_perm
 
-            p_inv = np.argsort(new_perm)
-
             d_ = min(avg_dim, n-1)
             # eta_vec = np.sum(abs(embedding[r, :d_] - embedding[c, :d_]), axis=1)
-            eta_mat = np.identity(n).flatten()
+            eta_mat.fill(0.)
+            np.fill_diagonal(eta_mat, 1.)
             for dim in range(d_):
                 # eta_mat = eta_mat + abs(np.tile(embedding[:, dim], n) - np.repeat(embedding[:, dim], n))
-                d_perm = np.argsort(embedding[:, dim])
-                d_perm = np.argsort(d_perm)
-                eta_add = abs(np.tile(d_perm, n) - np.repeat(d_perm, n))
-                if circular:
-                    eta_add = np.minimum(eta_add, n - eta_add)
-
-                eta_add = np.maximum(dh, eta_add)
-
-                if avg_scaling:
-                    eta_add = eta_add * 1./np.sqrt((1 + dim))
-                
-                eta_mat = eta_mat + eta_add
+                d_perm = _ranks(embedding[:, dim])
+                scale = 1./np.sqrt(1 + dim) if avg_scaling else 1.
+                _dense_eta(d_perm, eta_mat, n, dh, circular, scale, True)
 
 
             # eta_mat = abs(np.tile(p_inv, n) - np.repeat(p_inv, n))
             # if circular:
             #     # pass
             #     eta_mat = np.minimum(eta_mat, n - eta_mat)
-            eta_mat = np.reshape(eta_mat, (n, n))
             # eta_mat = np.maximum(dh, eta_mat)
 
             if do_plot: